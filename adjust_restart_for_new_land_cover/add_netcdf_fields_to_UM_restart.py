@@ -1,7 +1,10 @@
+import numpy
 import xarray
 import mule
 import six
 import argparse
+import re
+from um_restart_common import index_fields_by_stash
 
 def _parse_args():
     """Read the command line arguments."""
@@ -36,44 +39,59 @@ def _parse_args():
 
     return parser.parse_args()
 
-def modify_UM_field_by_name(FieldsFile, Dataset, VarName):
+def index_stash_by_name(StashMaster):
+    """Build a dictionary of the stash codes in the STASHmaster, keyed by the
+    name of the entry with "/" replaced by " PER ", as in the NetCDF names.
+    Where names are repeated, keep the first entry, as by_regex would."""
+
+    NameIndex = {}
+    for StashEntry in StashMaster.values():
+        NameIndex.setdefault(
+                StashEntry.name.replace('/', ' PER '),
+                StashEntry.item
+                )
+
+    return NameIndex
+
+def modify_UM_field_by_name(FieldsFile, StashIndex, NameIndex, Dataset,
+                            VarName):
     """Take the DataArray attached to Dataset[VarName] and map it to the
-    equivalent field in the UM fields file."""
+    equivalent field in the UM fields file. StashIndex is the dictionary of
+    fields keyed by stash code, from index_fields_by_stash, and NameIndex the
+    dictionary of stash codes keyed by name, from index_stash_by_name."""
 
     # We will want to check against the original FieldsFile field, to ensure
-    # matching sizes
-    VariableData = Dataset[VarName].to_numpy()
+    # matching sizes. Make sure the data is C-contiguous, so each tile is a
+    # contiguous block for mule to write out.
+    VariableData = numpy.ascontiguousarray(Dataset[VarName].to_numpy())
     nVeg, nLat, nLon = VariableData.shape
 
-    # Retrieve the stash code- UM does regex searching, so make sure to escape
-    # any brackets
-    UMName = VarName.replace('(', '\(').replace(')', '\)')
-    try:
-        StashCode = list(FieldsFile.stashmaster.by_regex(UMName).values())[0].item
-    except:
-        # A little catch for the "/" for " PER " replacement
-        print(f"Finding {UMName} failed; try again replacing PER")
-        UMName = UMName.replace(' PER ', '/')
-        StashCode = list(FieldsFile.stashmaster.by_regex(UMName).values())[0].item
+    # Retrieve the stash code- the NetCDF names should be exactly the stash
+    # names, so try a direct lookup first
+    StashCode = NameIndex.get(VarName)
+
+    if StashCode is None:
+        # Fall back to the UM regex searching, so make sure to escape any
+        # special characters such as brackets
+        UMName = re.escape(VarName)
+        try:
+            StashCode = list(FieldsFile.stashmaster.by_regex(UMName).values())[0].item
+        except:
+            # A little catch for the "/" for " PER " replacement
+            print(f"Finding {VarName} failed; try again replacing PER")
+            UMName = re.escape(VarName.replace(' PER ', '/'))
+            StashCode = list(FieldsFile.stashmaster.by_regex(UMName).values())[0].item
 
     # Check that the number of fields is the same as the vegetation dimension
-    nFields = 0
-    for Field in FieldsFile.fields:
-        if Field.lbuser4 == StashCode:
-            nFields += 1
-
-    assert nFields == nVeg
+    Fields = StashIndex.get(StashCode, [])
+    assert len(Fields) == nVeg
 
     # Iterate through tiles
-    Tile = 0
-    for Field in FieldsFile.fields:
-        if Field.lbuser4 == StashCode:
-            NewData = VariableData[Tile, :, :]
-            DataProvider = mule.ArrayDataProvider(NewData)
-            Field.set_data_provider(DataProvider)
-            Tile += 1
-
-# Intercept the write function to disable validation
+    for (Field, NewData) in zip(Fields, VariableData):
+        DataProvider = mule.ArrayDataProvider(NewData)
+        Field.set_data_provider(DataProvider)
+
+# Replacement for the write function with validation disabled
 def to_file(self, output_file_or_path):
         """
         Write to an output file or path.
@@ -84,19 +102,11 @@ def to_file(self, output_file_or_path):
                 closed again afterwards.
 
         .. Note::
-            As part of this the "validate" method will be called. For the
-            base :class:`UMFile` class this does nothing, but sub-classes
-            may override it to provide specific validation checks.
+            Unlike :meth:`UMFile.to_file`, the "validate" method is not
+            called. The UM7 restart doesn't pass validation, and validating
+            would only produce warnings while walking every field.
 
         """
-        # Call validate - to ensure the file about to be written out doesn't
-        # contain obvious errors.  This is done here before any new file is
-        # created so that we don't create a blank file if the validation fails
-        if isinstance(output_file_or_path, six.string_types):
-            self.validate(filename=output_file_or_path, warn=True)
-        else:
-            self.validate(filename=output_file_or_path.name, warn=True)
-
         if isinstance(output_file_or_path, six.string_types):
             with open(output_file_or_path, 'wb') as output_file:
                 self._write_to_file(output_file)
@@ -120,10 +130,12 @@ if __name__ == '__main__':
     BaseRestart.attach_stashmaster_info(SMBase.by_section(0))
 
     # Drop in the variables to modify
+    StashIndex = index_fields_by_stash(BaseRestart)
+    NameIndex = index_stash_by_name(BaseRestart.stashmaster)
     for Variable in ProcessedRestart.data_vars:
-        modify_UM_field_by_name(BaseRestart, ProcessedRestart, Variable)
+        modify_UM_field_by_name(BaseRestart, StashIndex, NameIndex,
+                                ProcessedRestart, Variable)
 
     # Write to file- since the UM7 restart doesn't match their expected format
-    # for some reason, we need to override the existing to_file
-    BaseRestart.to_file = to_file
-    BaseRestart.to_file(BaseRestart, args.output)
+    # for some reason, we need to write without the validation in to_file
+    to_file(BaseRestart, args.output)
@@ -1,6 +1,7 @@
 import argparse
 import yaml
 import numpy
+import scipy.ndimage
 import xarray
 
 def _parse_args():
@@ -78,114 +79,116 @@ def prepare_mapping(nVeg, ConfigFile):
     
     return MappingConf
 
-def setup_output_dataset(OutputVegetation):
-    """Use the OutputVegetation as a template to set up the Dataset that will
-    contain the new restart information. Use the list of variable names
-    contained in the Config to set the NetCDF variable names."""
+def setup_output_coords(OutputVegetation):
+    """Use the OutputVegetation as a template to set up the coordinates of the
+    Dataset that will contain the new restart information."""
 
     # Get the shape of the output data to perform validation
     nOutputVeg, nLat, nLon = OutputVegetation.shape
 
-    # Set up the new xarray dataset to write to
+    # Set up the coordinates of the new xarray dataset to write to
     Longitudes = numpy.linspace(0.0, 360.0, nLon, endpoint=False)
     Latitudes = numpy.linspace(-90.0, 90.0, nLat, endpoint=True)
     VegTypes = numpy.arange(1, nOutputVeg+1)
 
-    # I couldn't make the xarray.Dataset call accept a dictionary generator as
-    # an argument for data_vars. So initialise the Dataset, then add variables
-    # to it later.
-    OutDataset = xarray.Dataset(
-            coords={
-                'lon': Longitudes,
-                'lat': Latitudes,
-                'veg': VegTypes
-                }
-            )
+    # The variables are collected separately, and the Dataset built from
+    # them and these coordinates in one go once they're all complete.
+    OutCoords = {
+            'lon': Longitudes,
+            'lat': Latitudes,
+            'veg': VegTypes
+            }
 
-    return OutDataset
+    return OutCoords
                     
-def modify_mask_for_cell(SearchMask, GridCell, Coord):
-    """Modify the input search mask to only include the current grid cell at
-    Coord."""
+def sum_over_cell(Field, GridCell):
+    """Sum the Field over only the current grid cell, which is just the Field
+    itself. Include arguments for consistency with the other search methods."""
 
-    Lon, Lat = Coord
-    SearchMask[Lat, Lon] = True
+    return Field
 
-def modify_mask_for_nearest(SearchMask, SearchRadius, Coord):
-    """Modify the input search mask to only include the specified 'radius' of
-    points around the given Coord. In this instance, radius is just a block of
-    points with index +-SearchRadius around the original Coord."""
-    
-    # Destructure for more readable usage later
-    Lon, Lat = Coord
-    nLat, nLon = SearchMask.shape
+def sum_over_block(Field, LatRadius, LonRadius):
+    """Sum the Field over the block of points with latitude index +-LatRadius
+    and longitude index +-LonRadius around every grid cell. The sums over the
+    block are computed for all cells at once with a pair of 1D convolutions."""
 
-    # Create the set of coordinates to unmask
-    SearchInds = numpy.arange(-SearchRadius, SearchRadius+1)
+    nLat, nLon = Field.shape[-2:]
 
-    # Clip the latitude indices, since they aren't periodic
-    LatInds = numpy.clip(Lat + SearchInds, 0, nLat-1)
+    # The latitudes aren't periodic, so points off the edge of the grid
+    # contribute nothing to the sum
+    LatKernel = numpy.ones(2*LatRadius+1)
+    FieldSum = scipy.ndimage.convolve1d(Field, LatKernel, axis=-2,
+                                        mode='constant', cval=0.0)
+
+    # The longitudes are periodic, so wrap around the grid. Don't let the
+    # kernel exceed the grid, otherwise points would be counted twice.
+    LonKernel = numpy.ones(min(2*LonRadius+1, nLon))
+    FieldSum = scipy.ndimage.convolve1d(FieldSum, LonKernel, axis=-1,
+                                        mode='wrap')
 
-    # Apply mod to longitude indices, since they are periodic
-    LonInds = numpy.mod(Lon + SearchInds, nLon)
+    return FieldSum
 
-    # Modify the mask in place
-    for LatSearch in LatInds:
-        for LonSearch in LonInds:
-            SearchMask[LatSearch, LonSearch] = True
+def sum_over_nearest(Field, SearchRadius):
+    """Sum the Field over the specified 'radius' of points around every grid
+    cell. In this instance, radius is just a block of points with index
+    +-SearchRadius around the original cell."""
 
-def modify_mask_for_latitude_band(SearchMask, LatitudeBand, Coord):
-    """Modify the input search mask to only include the specifed band of
-    latitudes around the given Coord."""
+    return sum_over_block(Field, SearchRadius, SearchRadius)
 
-    # Destructure for more readable usage later
-    Lon, Lat = Coord
-    nLat, nLon = SearchMask.shape
+def sum_over_latitude_band(Field, BandParams):
+    """Sum the Field over the specified band of latitudes around every grid
+    cell, using a cumulative sum over the latitudes. BandParams is the
+    latitude band and the search radius of the previous search."""
 
-    # Create the set of coordinates to unmask
-    SearchInds = numpy.arange(-LatitudeBand, LatitudeBand+1)
+    LatitudeBand, SearchRadius = BandParams
+    nLat, nLon = Field.shape[-2:]
+
+    # Cumulative sum of the zonal sums, with a leading 0 so that the sum over
+    # the latitudes [Start, End] is just CumSum[End+1] - CumSum[Start]
+    ZonalSum = Field.sum(axis=-1)
+    CumSum = numpy.zeros(ZonalSum.shape[:-1] + (nLat+1,))
+    numpy.cumsum(ZonalSum, axis=-1, out=CumSum[..., 1:])
 
     # Clip the latitude indices, since they aren't periodic
-    LatInds = numpy.clip(Lat + SearchInds, 0, nLat-1)
+    LatInds = numpy.arange(nLat)
+    StartInds = numpy.clip(LatInds - LatitudeBand, 0, nLat-1)
+    EndInds = numpy.clip(LatInds + LatitudeBand, 0, nLat-1)
 
-    # Modify the mask in place
-    for LatSearch in LatInds:
-        SearchMask[LatSearch, :] = True
+    BandSum = CumSum[..., EndInds+1] - CumSum[..., StartInds]
 
-def modify_mask_for_global(SearchMask, Global, Coord):
-    """Modify the input search mask to include the whole globe. Include
-    arguments for consistency with the other masking methods."""
+    # The band is the same for every longitude
+    BandSum = numpy.broadcast_to(BandSum[..., numpy.newaxis], Field.shape)
 
-    # Nothing interesing to do here
-    SearchMask[:] = True
+    # The search area for the band also includes the nearest block of points
+    # searched before it. This only matters when the block reaches further
+    # than the band, in which case add on the rows of the block outside it.
+    if SearchRadius > LatitudeBand:
+        BandSum = BandSum + \
+                sum_over_block(Field, SearchRadius, SearchRadius) - \
+                sum_over_block(Field, LatitudeBand, SearchRadius)
 
-def find_active_tiles(
-        SearchMask,
-        InputVegetation,
-        VegetationMapping,
-        ):
-    """Using the supplied search mask, generate a set of masks which are an OR
-    of the original search mask and a mask describing the active tiles, defined
-    as a tile with an area fraction of greater than 0.0. Generates a mask for
-    each of the vegetation types used to construct the new vegetation type."""
-
-    # Make it a list, because there are instances where more than 1 input
-    # vegetation type maps to a single output vegetation type
-    ActiveTileMasks = []
-
-    for VegType in VegetationMapping:
-        # The search mask should then be a logical and of:
-        # * The land points (where the vegetation is non nan)
-        # * The supplied search mask
-        # * The tiles which have a vegetation type greater than 0.0
-        # Note that the minimum area threshold is chosen carefully to be
-        # greater than 0.0, which is the value used for tiles that will become
-        # active in future due to land use change
-        TileSearchMap = ~numpy.isnan(InputVegetation[VegType, :, :]) &\
-                SearchMask &\
-                (InputVegetation[VegType, :, :] > 0.0)
-
-        ActiveTileMasks.append(TileSearchMap)
+    return BandSum
+
+def sum_over_global(Field, Global):
+    """Sum the Field over the whole globe. Include arguments for consistency
+    with the other search methods."""
+
+    GlobalSum = Field.sum(axis=(-2, -1), keepdims=True)
+
+    return numpy.broadcast_to(GlobalSum, Field.shape)
+
+def find_active_tiles(InputVegetation):
+    """Generate a mask describing the active tiles, defined as a tile with an
+    area fraction of greater than 0.0. Generates a mask for every vegetation
+    type at once, so it only needs to be computed once."""
+
+    # The active tiles are a logical and of:
+    # * The land points (where the vegetation is non nan)
+    # * The tiles which have a vegetation type greater than 0.0
+    # Note that the minimum area threshold is chosen carefully to be
+    # greater than 0.0, which is the value used for tiles that will become
+    # active in future due to land use change
+    ActiveTileMasks = ~numpy.isnan(InputVegetation) & (InputVegetation > 0.0)
 
     return ActiveTileMasks
 
@@ -211,19 +214,22 @@ def remap_vegetation(
     LatitudeBand = MappingConf['latitude_band']
     MinPointsFound = MappingConf['minimum_points']
     
-    # Set up the Dataset we're going to write to
-    OutDataset = setup_output_dataset(OutputVegetation)
+    # Set up the coordinates and variables of the Dataset we're going to write
+    # to. Adding variables to an existing Dataset one at a time is slow, so
+    # collect them first and build the Dataset at the end.
+    OutCoords = setup_output_coords(OutputVegetation)
+    OutVariables = {}
 
     # Set the fill value that we will use for all variables
     FillVal = 1e20
 
     # Add the land fractions- also include previous year as same for LUC
-    OutDataset['FRACTIONS OF SURFACE TYPES'] = (('veg', 'lat', 'lon'),
-                                               OutputVegetation)
+    OutVariables['FRACTIONS OF SURFACE TYPES'] = (('veg', 'lat', 'lon'),
+                                                 OutputVegetation)
 
     # Assume the previous year surface fractions are just the same as current,
     # unless otherwise specified
-    OutDataset['PREVIOUS YEAR SURF FRACTIONS (TILES)'] = \
+    OutVariables['PREVIOUS YEAR SURF FRACTIONS (TILES)'] = \
         (('veg', 'lat', 'lon'), PreviousVegetation)
 
     # We need to know which tiles to fill, and which to empty. This depends on
@@ -251,121 +257,131 @@ def remap_vegetation(
         #        )
         TilesToEmpty = OutputVegetation <= 0.0
 
+    # The masks are used to index every variable, so convert them to indices
+    # once rather than scanning the whole mask on every use
+    FillInds = numpy.nonzero(TilesToFill)
+    EmptyInds = numpy.nonzero(TilesToEmpty)
+
+    # Find the active tiles for every input vegetation type once, for use in
+    # both the per-cell and per-tile averaging
+    ActivePerVeg = find_active_tiles(InputVegetation)
+
     # Perform the per-cell averaging
-    # Apply a mask to the array, so we don't mess up our summations with
-    # near-zero vegetation fractions
-    MaskedInputVegetation = numpy.ma.masked_where(
-            numpy.logical_or(
-                InputVegetation <= 0.0,
-                numpy.isnan(InputVegetation)
-                ),
-            InputVegetation)
+    # Only sum over the active tiles, so we don't mess up our summations with
+    # near-zero vegetation fractions. Select them with numpy.where rather than
+    # a masked array, which is much slower to do arithmetic with.
 
     # And create 
     for Variable in PerCellVariables:
-        AreaWeightedMean = numpy.stack(
-                [numpy.sum(
-                    InputDataset[Variable].to_numpy() * MaskedInputVegetation,
-                    axis=0
-                    )] * nOutputVeg,
-                axis=0
-                )
+        # Only read the variable from the input once
+        OutData = InputDataset[Variable].to_numpy()
+
+        # The mean is the same for every tile in the cell, so broadcast it
+        # across the tiles rather than making a copy for each
+        CellMean = numpy.where(
+                ActivePerVeg,
+                OutData * InputVegetation,
+                0.0
+                ).sum(axis=0)
+        AreaWeightedMean = numpy.broadcast_to(CellMean, (nOutputVeg, nLat, nLon))
         
         # Only apply the averaging process to tiles that don't already exist-
         # do this by initially copying over the original fields, then writing
         # over the tiles to fill
-        OutData = InputDataset[Variable].to_numpy()
-        OutData[TilesToFill] = AreaWeightedMean[TilesToFill]
-        OutData[TilesToEmpty] = 0
+        OutData[FillInds] = AreaWeightedMean[FillInds]
+        OutData[EmptyInds] = 0
 
-        OutDataset[Variable] = (('veg', 'lat', 'lon'), OutData)
-        OutDataset[Variable].encoding['_FillValue'] = FillVal
+        OutVariables[Variable] = (('veg', 'lat', 'lon'), OutData)
         
     # For the per tile variables, start by initialising with the old data, then
-    # removing the tiles that have left existence
+    # removing the tiles that have left existence. Work on copies in plain
+    # numpy arrays, so the input Dataset is left untouched, and only add them
+    # to the Dataset once they're complete.
+    # The searches below read from these buffers, so the emptied tiles count
+    # as zeros in the averages, as they always have. The filled tiles are
+    # never active, so filling them doesn't affect later searches.
+    OutBuffers = {}
     for Variable in PerTileVariables:
-        OutData = InputDataset[Variable].to_numpy()
-        OutData[TilesToEmpty] = 0
+        OutData = InputDataset[Variable].to_numpy().copy()
+        OutData[EmptyInds] = 0
 
-        OutDataset[Variable] = (('veg', 'lat', 'lon'), OutData)
-        OutDataset[Variable].encoding['_FillValue'] = FillVal
+        OutBuffers[Variable] = OutData
 
     # Perform the per-tile averaging
-    # To only iterate over desired points, we can mask the array where so that
-    # only TilesToFill are unmasked.
-    MaskedOutputVeg = numpy.ma.masked_array(OutputVegetation, mask=~(TilesToFill))
-
-    # At each point, we're going to use a new mask to assist the search. But we
-    # don't want to allocate a new array every point- initialise a mask here,
-    # and then modify the mask in place.
-    SearchMask = numpy.full((nLat, nLon), False, dtype=bool)
-
-    # Set up the set of search methods and search parameters to walk through
+    # Rather than searching around each tile to fill in turn, compute the sums
+    # for every search method over the whole grid at once, then pick the
+    # first successful search method for each grid cell.
     SearchMethods = [
-            modify_mask_for_cell,
-            modify_mask_for_nearest,
-            modify_mask_for_latitude_band,
-            modify_mask_for_global
+            sum_over_cell,
+            sum_over_nearest,
+            sum_over_latitude_band,
+            sum_over_global
             ]
 
     # The cell and global searches take no parameters
-    SearchParams = [None, SearchRadius, LatitudeBand, None]
+    SearchParams = [None, SearchRadius, (LatitudeBand, SearchRadius), None]
 
     # The minimum number of points permitted for a search to be successful
     PointsThreshold = [1, MinPointsFound, MinPointsFound, 1]
 
-    # Start by iterating through each output vegetation type
-    counter = 0
-    for (OutVeg, Lat, Lon), _ in numpy.ma.ndenumerate(MaskedOutputVeg):
-        
-        # Iterate through the search methods until a success
-        for Method, Param, MinPoints in zip(SearchMethods, SearchParams,
-                                            PointsThreshold):
-            Method(SearchMask, Param, (Lon, Lat))
-
-            # Further refine the mask to only include the active tiles
-            ActiveTileMasks = find_active_tiles(
-                    SearchMask,
-                    InputVegetation,
-                    VegMapping[OutVeg]
-                    )
-
-            # Check how many valid points there are in the mask
-            PointsFound = sum([ActiveTileMask.sum() for ActiveTileMask in
-                              ActiveTileMasks])
-
-            if PointsFound >= MinPoints:
-                # Search was successful
-                break
-
-        # Now we can continue with a generic masked find and average
+    # Start by iterating through each output vegetation type, skipping those
+    # with nothing to fill
+    for OutVeg in numpy.unique(FillInds[0]):
+        # Find where to fill for this vegetation type
+        FillMask = TilesToFill[OutVeg, :, :]
+
+        # Take the active tiles of the input vegetation types which map to
+        # this output vegetation type. There are instances where more than 1
+        # input vegetation type maps to a single output vegetation type.
+        ActiveTileMasks = ActivePerVeg[VegMapping[OutVeg], :, :]
+
+        # We want to summate over all active tiles then average by the number
+        # of active tiles. In most cases, this only involves one vegetation
+        # type, but sometimes there are more.
+        # Stack the number of active tiles with the totals of each variable,
+        # so that each search method is applied to all of them in one go.
+        ActiveSums = numpy.empty((len(PerTileVariables)+1, nLat, nLon))
+        ActiveSums[0, :, :] = ActiveTileMasks.sum(axis=0)
+        for (i, Variable) in enumerate(PerTileVariables, start=1):
+            ActiveSums[i, :, :] = numpy.where(
+                    ActiveTileMasks,
+                    OutBuffers[Variable][VegMapping[OutVeg], :, :],
+                    0.0
+                    ).sum(axis=0, dtype=numpy.float64)
+
+        # Walk through the search methods from widest to narrowest, so that
+        # the narrowest successful search method is the one that remains
+        FoundSums = numpy.zeros_like(ActiveSums)
+        for Method, Param, MinPoints in reversed(list(zip(
+                SearchMethods, SearchParams, PointsThreshold))):
+            SearchSums = Method(ActiveSums, Param)
+
+            Success = SearchSums[0, :, :] >= MinPoints
+            numpy.copyto(FoundSums, SearchSums, where=Success)
+
+        PointsFound = FoundSums[0, :, :]
+        Total = FoundSums[1:, :, :]
+
         # There are some veg types that don't have any values anywhere
         # In that case, just use zeros everywhere.
-        if PointsFound < MinPointsFound:
-            for Variable in PerTileVariables:
-                OutDataset[Variable][OutVeg, Lat, Lon] = 0.0
-        else:
-            for Variable in PerTileVariables:
-                # Set incrementing value to 0
-                Total = 0.0
-
-                # We want to summate over all active tiles then average by the
-                # number of active tiles. In most cases, this only involves one
-                # vegetation type, but sometimes there are more.
-                for (InVeg, TileMask) in \
-                        zip(VegMapping[OutVeg], ActiveTileMasks):
-                    # Turn the data into a numpy array, then index it with the
-                    # generated mask.
-                    VarData = InputDataset[Variable][InVeg, :, :].to_numpy()
-                    TotalForVegType = VarData[TileMask].sum()
-                    Total += TotalForVegType
-
-                # Average and set the index in the dataarray.
-                OutDataset[Variable][OutVeg, Lat, Lon] =\
-                        Total / PointsFound
-
-        # Reset the search mask to false
-        SearchMask[:] = False
+        Mean = numpy.divide(
+                Total,
+                PointsFound,
+                out=numpy.zeros_like(Total),
+                where=PointsFound >= MinPointsFound
+                )
+
+        # Set only the tiles to fill
+        for (Variable, VariableMean) in zip(PerTileVariables, Mean):
+            OutBuffers[Variable][OutVeg, FillMask] = VariableMean[FillMask]
+
+    for Variable in PerTileVariables:
+        OutVariables[Variable] = (('veg', 'lat', 'lon'), OutBuffers[Variable])
+
+    OutDataset = xarray.Dataset(data_vars=OutVariables, coords=OutCoords)
+
+    for Variable in PerCellVariables + PerTileVariables:
+        OutDataset[Variable].encoding['_FillValue'] = FillVal
 
     return OutDataset
 
@@ -373,7 +389,9 @@ if __name__ == '__main__':
 
     # Process command line args
     args = _parse_args()
-    OrigDataset = xarray.open_dataset(args.input)
+    # Open lazily with the on-disk chunking, so that each variable is only read
+    # when it's needed rather than held in memory for the whole run
+    OrigDataset = xarray.open_dataset(args.input, chunks={})
     OrigVegetation = OrigDataset['FRACTIONS OF SURFACE TYPES'].to_numpy()
 
     Vegetation = xarray.open_dataset(args.vegetation_map)
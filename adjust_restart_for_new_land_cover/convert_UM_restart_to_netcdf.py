@@ -2,6 +2,14 @@ import argparse
 import mule
 import xarray
 import numpy
+from um_restart_common import index_fields_by_stash
+
+# We know the latitude and longitude of the UM7 grid, so set them up once
+LONGITUDES = numpy.linspace(0.0, 360.0, 192)
+LATITUDES = numpy.linspace(-90.0, 90.0, 145, endpoint=True)
+
+# We can set the vegetation dimension- just 1-17
+VEG_TYPES = numpy.arange(1, 18)
 
 def _parse_args():
     """Read the command line arguments."""
@@ -35,30 +43,34 @@ def convert_restart(RestartFile, OutputFile):
     Convert the UM restart to NetCDF
     """
 
-    # We know the latitude and longitude
-    Longitudes = numpy.linspace(0.0, 360.0, 192)
-    Latitudes = numpy.linspace(-90.0, 90.0, 145, endpoint=True)
-
-    # We can set the vegetation dimension- just 1-17
-    VegTypes = numpy.arange(1, 18)
+    # Set up the coordinates for the xarray dataset. The variables are
+    # collected separately, and the Dataset built in one go at the end.
+    RestartCoords = {
+            "lon": ("longitude", LONGITUDES),
+            "lat": ("latitude", LATITUDES),
+            "nVeg": ("nVeg", VEG_TYPES)
+            }
+    RestartVariables = {}
 
-    # Set up the xarray dataset
-    RestartDataset = xarray.Dataset(
-            coords={
-                "lon": ("longitude", Longitudes),
-                "lat": ("latitude", Latitudes),
-                "nVeg": ("nVeg", VegTypes)
-                }
-            )
+    # Group the fields by stash code once, rather than searching through all
+    # the fields for every stash entry
+    StashIndex = index_fields_by_stash(RestartFile)
 
     # Build the land mask by inspecting the LAND MASK (no halo) field
     LandMaskStash = RestartFile.stashmaster.by_regex("LAND MASK")
     MaskStashCode = list(LandMaskStash.values())[0].item
 
-    for Field in RestartFile.fields:
-        if Field.lbuser4 == MaskStashCode:
-            Mask = Field.get_data() == 0.0
-            break
+    Mask = StashIndex[MaskStashCode][0].get_data() == 0.0
+
+    # The per tile fields all share the same shape and mask. Broadcast the
+    # mask across the tiles without copying it, and allocate a single buffer
+    # to read the tiles into- masked_where copies the data, so the buffer can
+    # be reused for every per tile field.
+    TileData = numpy.empty(
+            (VEG_TYPES.size, LATITUDES.size, LONGITUDES.size),
+            dtype=numpy.float32
+            )
+    TileMask = numpy.broadcast_to(Mask, TileData.shape)
 
     # We'll just iterate through the entries in the stash, and pull the stash
     # codes and get the relevant field
@@ -71,45 +83,43 @@ def convert_restart(RestartFile, OutputFile):
         FieldName = FieldName.replace('/', ' PER ')
 
         # Count the number of fields with the given stash code
-        NFields = 0
-        for (i, Field) in enumerate(RestartFile.fields):
-            if Field.lbuser4 == StashCode:
-                NFields += 1
+        Fields = StashIndex.get(StashCode, [])
+        NFields = len(Fields)
 
         # It should either be 1, for grid cell values, or 17 for values on
         # tiles
         if NFields == 1:
             # A grid cell field, not per vegetation type
             try:
-                for Field in RestartFile.fields:
-                    if Field.lbuser4 == StashCode:
-                        FieldData = numpy.ma.masked_array(
-                                Field.get_data(),
-                                mask=Mask
-                                )
+                FieldData = numpy.ma.masked_array(
+                        Fields[0].get_data(),
+                        mask=Mask
+                        )
                 if FieldData.size == (145, 192):
-                    RestartDataset[FieldName] = (('lat', 'lon'), FieldData)
+                    RestartVariables[FieldName] = (('lat', 'lon'), FieldData)
             except:
                 print(f"Failed to convert field {FieldName}")
                 pass
 
         elif NFields == 17:
-            # A per tile field
-            FieldData = numpy.ndarray((17, 145, 192), dtype = numpy.float32)
-            Veg = 0
-            for Field in RestartFile.fields:
-                if Field.lbuser4 == StashCode:
-                    FieldData[Veg, :, :] = Field.get_data()
-                    Veg += 1
+            # A per tile field- mule can't read into an existing array, so
+            # copy each tile straight into the buffer
+            for (Veg, Field) in enumerate(Fields):
+                numpy.copyto(TileData[Veg, :, :], Field.get_data())
             
-            RestartDataset[FieldName] = (
+            RestartVariables[FieldName] = (
                     ('nVeg', 'lat', 'lon'),
                     numpy.ma.masked_where(
-                        numpy.repeat(Mask[numpy.newaxis, :, :], 17, axis=0),
-                        FieldData,
+                        TileMask,
+                        TileData,
                         1e20)
                     )
 
+    RestartDataset = xarray.Dataset(
+            data_vars=RestartVariables,
+            coords=RestartCoords
+            )
+
     RestartDataset.to_netcdf(OutputFile)
 
 if __name__ == '__main__':
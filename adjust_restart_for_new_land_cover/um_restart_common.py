@@ -0,0 +1,12 @@
+from collections import defaultdict
+
+def index_fields_by_stash(FieldsFile):
+    """Build a dictionary of the fields in the UM fields file, keyed by stash
+    code, so the fields for a given stash code can be found without searching
+    every field in the file."""
+
+    StashIndex = defaultdict(list)
+    for Field in FieldsFile.fields:
+        StashIndex[Field.lbuser4].append(Field)
+
+    return StashIndex
@@ -13,6 +13,10 @@ import io
 import hashlib
 from datetime import datetime
 
+# Size of the chunks to read when hashing files without hashlib.file_digest. Large chunks
+# mean fewer calls into hashlib for multi-GB files.
+MD5_CHUNK_SIZE = 4 * 1024 * 1024
+
 
 def get_git_url(file):
     """
@@ -135,12 +139,37 @@ def get_provenance_metadata(file, runcmd):
 def md5sum(path):
     """
     Return the md5 hash of a provided file, reading in chunks to reduce memory usage for
-    large files.
-    From https://stackoverflow.com/a/40961519
+    large files. Uses hashlib.file_digest where available (Python >= 3.11), which reads
+    straight into a reusable buffer, otherwise reads in chunks of MD5_CHUNK_SIZE.
+    Adapted from https://stackoverflow.com/a/40961519
     """
-    length = io.DEFAULT_BUFFER_SIZE
-    md5 = hashlib.md5()
     with io.open(path, mode="rb") as fd:
-        for chunk in iter(lambda: fd.read(length), b""):
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(fd, "md5").hexdigest()
+
+        md5 = hashlib.md5()
+        for chunk in iter(lambda: fd.read(MD5_CHUNK_SIZE), b""):
             md5.update(chunk)
     return md5.hexdigest()
+
+
+def fadvise(path, advice):
+    """
+    Advise the kernel how the whole of the provided file is going to be accessed, e.g.
+    "WILLNEED" to start reading it into the page cache in the background, or "DONTNEED"
+    to drop it from the page cache once finished with. Does nothing on platforms without
+    os.posix_fadvise or the requested advice.
+
+    arguments:
+        path: the path to the file
+        advice: the name of the advice, i.e. os.POSIX_FADV_<advice>
+    """
+    advice = getattr(os, f"POSIX_FADV_{advice}", None)
+    if not hasattr(os, "posix_fadvise") or advice is None:
+        return
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, advice)
+    finally:
+        os.close(fd)
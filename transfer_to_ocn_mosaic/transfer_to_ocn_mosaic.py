@@ -27,7 +27,10 @@
 import os
 import sys
 from pathlib import Path
+import shutil
 import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from netCDF4 import Dataset
 import esmgrids
 from esmgrids.mom_grid import MomGrid
@@ -36,68 +39,51 @@ from esmgrids.cice_grid import CiceGrid
 path_root = Path(__file__).parents[1]
 sys.path.append(str(path_root))
 
-from scripts_common import get_provenance_metadata, md5sum
-
-def copy_netcdf(src_file, dst_file):
-    """Copy a netcdf file to a new location and return the new Dataset"""
-    dst = Dataset(dst_file, "w")
-    with Dataset(src_file) as src:
-        # Copy global attributes
-        dst.setncatts(src.__dict__)
-        # Copy dimensions
-        for name, dimension in src.dimensions.items():
-            dst.createDimension(
-                name, (len(dimension) if not dimension.isunlimited() else None))
-        # Copy all variables
-        for name, variable in src.variables.items():
-            x = dst.createVariable(name, variable.datatype, variable.dimensions)
-            # copy variable attributes all at once via dictionary
-            dst[name].setncatts(src[name].__dict__)
-            dst[name][:] = src[name][:]
-    return dst
+from scripts_common import fadvise, get_provenance_metadata, md5sum
 
-def main():
-    parser = argparse.ArgumentParser(
-        description="Update the ocean grid in ACCESS-ESM1.6 from FMS legacy to mosaic format."
-    )
-
-    parser.add_argument(
-        "--output-dir",
-        type=str,
-        required=True,
-        help="The directory to write the output netcdf files.",
-    )
-
-    args = parser.parse_args()
-    output_dir = Path(os.path.abspath(args.output_dir))
-
-    curr_gspec = Path(
-        "/g/data/vk83/configurations/inputs/access-esm1p5/modern/share/ocean/grids/mosaic/global.1deg/2020.05.19/grid_spec.nc"
-    )
-    curr_cgrids = Path(
-        "/g/data/vk83/configurations/inputs/access-esm1p5/modern/share/coupler/grids/global.oi_1deg.a_N96/2020.05.19/grids.nc"
-    )
-    curr_careas = Path(
-        "/g/data/vk83/configurations/inputs/access-esm1p5/modern/share/coupler/grids/global.oi_1deg.a_N96/2020.05.19/areas.nc"
-    )
-    
-    # Get provenance metadata
-    # --------------------------------------------
-    this_file = os.path.normpath(__file__)
-    metadata_history = get_provenance_metadata(
-        this_file,
-        f"python {os.path.basename(this_file)} --output-dir={output_dir}"
-    )
-    metadata_input_gspec = f"{curr_gspec} (md5 hash: {md5sum(curr_gspec)})"
-    metadata_input_cgrids = f"{curr_cgrids} (md5 hash: {md5sum(curr_cgrids)})"
-    metadata_input_careas = f"{curr_careas} (md5 hash: {md5sum(curr_careas)})"
+# Minimum number of rows of the depth to process at a time when creating the ocean
+# mask, which is also the number of rows in each chunk of the mask
+MASK_BLOCK_ROWS = 256
 
+def create_outputs(work_dir, curr_gspec, curr_cgrids, curr_careas, metadata_history, staged):
+    """
+    Create all the output files in work_dir. staged is whether work_dir is a staging
+    directory the files will be moved out of afterwards.
+    """
     # Update ocean grid to mosaic format using FRE-NCtools `transfer_to_mosaic_grid` with
     # `--rotate_poly`
     # --------------------------------------------
-    os.chdir(output_dir)
-    run_cmd = f"transfer_to_mosaic_grid --input_file {str(curr_gspec)} --rotate_poly"
-    subprocess.run(run_cmd, shell=True)
+    os.chdir(work_dir)
+    # Run the tool directly rather than through a shell
+    run_cmd = ["transfer_to_mosaic_grid", "--input_file", str(curr_gspec), "--rotate_poly"]
+    # Nothing else touches the outputs while FRE-NCtools writes them, so skip the HDF5
+    # file locking, which is slow on Lustre
+    run_env = {**os.environ, "HDF5_USE_FILE_LOCKING": "FALSE"}
+    # Run in the background, so that the input files can be hashed at the same time.
+    # Leaving the with block always waits for it to finish.
+    with subprocess.Popen(run_cmd, env=run_env) as transfer:
+        try:
+            # The input files are large and independent, so hash them concurrently
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                md5_gspec, md5_cgrids, md5_careas = executor.map(
+                    md5sum, [curr_gspec, curr_cgrids, curr_careas]
+                )
+        except BaseException:
+            # There's no point finishing the transfer if the inputs can't be hashed
+            transfer.terminate()
+            raise
+    if transfer.returncode != 0:
+        raise subprocess.CalledProcessError(transfer.returncode, run_cmd)
+
+    metadata_input_gspec = f"{curr_gspec} (md5 hash: {md5_gspec})"
+    metadata_input_cgrids = f"{curr_cgrids} (md5 hash: {md5_cgrids})"
+    metadata_input_careas = f"{curr_careas} (md5 hash: {md5_careas})"
+
+    # Start reading the outputs back in ahead of adding the metadata to them below.
+    # The advice is asynchronous, so the reads overlap with the clean up.
+    output_files = ["ocean_hgrid.nc", "ocean_mosaic.nc", "ocean_vgrid.nc", "topog.nc"]
+    for f in output_files:
+        fadvise(work_dir / f, "WILLNEED")
 
     # Clean up unneeded files
     remove_files = [
@@ -110,61 +96,104 @@ def main():
         "land_mosaicXocean_mosaic.nc",
         "mosaic.nc"
     ]
-    for f in remove_files:
-        (output_dir / f).unlink()
+    # Unlinks on a parallel filesystem are slow, so issue them concurrently. Don't fail
+    # if FRE-NCtools didn't produce one of them.
+    with ThreadPoolExecutor(max_workers=len(remove_files)) as executor:
+        list(executor.map(lambda f: (work_dir / f).unlink(missing_ok=True), remove_files))
 
     # Add provenance metadata to the output files
-    for f in ["ocean_hgrid.nc", "ocean_mosaic.nc", "ocean_vgrid.nc", "topog.nc"]:
-        output_file = output_dir / f
+    # Add history and input file metadata, all attributes in a single call per file
+    provenance_attrs = {
+        "history": metadata_history,
+        "inputFile": metadata_input_gspec,
+        "frenctools_version": FRENCTOOLS_VERSION,
+    }
+    for f in output_files:
+        output_file = work_dir / f
         with Dataset(output_file, "a") as ds:
-            # Add history and input file metadata
-            ds.history = metadata_history
-            ds.inputFile = metadata_input_gspec
-            ds.frenctools_version = FRENCTOOLS_VERSION
+            ds.setncatts(provenance_attrs)
 
     # Create ocean_mask.nc from new topog.nc
     # --------------------------------------------
-    # ocean_mask.nc is only needed for updating the CICE grid below
-    with Dataset(output_dir / "topog.nc") as topog:
-        depth = topog["depth"][:].data
+    # ocean_mask.nc is only needed for updating the CICE grid below. esmgrids can only
+    # take the mask as a file, so build it in memory and write it to disk in one go on
+    # close, ready to be read straight back.
+    with (
+        Dataset(work_dir / "topog.nc") as topog,
+        Dataset(work_dir / "ocean_mask.nc", "w", diskless=True, persist=True) as ocean_mask,
+    ):
+        depth = topog["depth"]
+        depth.set_auto_mask(False)
+        ny, nx = depth.shape
+
+        # Stream the mask through in blocks of rows, rather than holding the full
+        # depth and mask in memory. If depth is chunked (it isn't if it's contiguous,
+        # or in a netCDF-3 file), use a whole number of its chunks in each block so
+        # each read touches as few chunks as possible.
+        chunking = depth.chunking()
+        block_rows = MASK_BLOCK_ROWS
+        if isinstance(chunking, list):
+            block_rows = -(-MASK_BLOCK_ROWS // chunking[0]) * chunking[0]
 
-    with Dataset(output_dir / "ocean_mask.nc", "w") as ocean_mask:
-        ocean_mask.createDimension("ny", depth.shape[0])
-        ocean_mask.createDimension("nx", depth.shape[1])
+        # The mask is written in full, so don't prefill it with fill values
+        ocean_mask.set_fill_off()
+        ocean_mask.createDimension("ny", ny)
+        ocean_mask.createDimension("nx", nx)
+        # Chunk the mask in full rows matching the blocks it's written in. The default
+        # chunks are much smaller, and compress the mostly uniform mask less well.
         mask = ocean_mask.createVariable(
             "mask",
-            "i8",
+            "i1",
             dimensions=("ny", "nx"),
             compression="zlib",
-            complevel=1
+            complevel=1,
+            chunksizes=(min(ny, block_rows), nx)
         )
         mask.standard_name = "sea_binary_mask"
-        mask[:] = (depth > 0).astype(int)
+
+        for j0 in range(0, ny, block_rows):
+            rows = slice(j0, min(j0 + block_rows, ny))
+            mask[rows, :] = (depth[rows, :] > 0).astype("i1")
+
         ocean_mask.history = metadata_history
         ocean_mask.inputFile = metadata_input_gspec
+    # topog.nc is done with, unless it's about to be read again to move it
+    if not staged:
+        fadvise(work_dir / "topog.nc", "DONTNEED")
 
     # Update CICE grid using `esmgrids`
     # --------------------------------------------
     cice_grid = CiceGrid.fromgrid(
         MomGrid.fromfile(
-            output_dir / "ocean_hgrid.nc",
-            mask_file=output_dir / "ocean_mask.nc"
+            work_dir / "ocean_hgrid.nc",
+            mask_file=work_dir / "ocean_mask.nc"
         )
     )
-    cice_grid.write(
-        output_dir / "grid.nc",
-        output_dir / "kmt.nc",
-        metadata={
-            "history": metadata_history,
-            "inputFile": metadata_input_gspec,
-            "esmgrids_version": f"{esmgrids.__version__}",
-        },
-        variant="cice5-auscom"
-    )
-
     # Update coupler grids and areas
     # --------------------------------------------
-    grids = copy_netcdf(curr_cgrids, output_dir / "grids.nc")
+    # Only a handful of variables and attributes change, so copy the files byte for byte
+    # and update them in place. This also keeps the layout of the original files. The
+    # copies don't go through netCDF/HDF5, so run them in the background while writing
+    # the CICE grid.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        copies = [
+            executor.submit(shutil.copyfile, curr_cgrids, work_dir / "grids.nc"),
+            executor.submit(shutil.copyfile, curr_careas, work_dir / "areas.nc"),
+        ]
+        cice_grid.write(
+            work_dir / "grid.nc",
+            work_dir / "kmt.nc",
+            metadata={
+                "history": metadata_history,
+                "inputFile": metadata_input_gspec,
+                "esmgrids_version": f"{esmgrids.__version__}",
+            },
+            variant="cice5-auscom"
+        )
+        for copy in copies:
+            copy.result()
+
+    grids = Dataset(work_dir / "grids.nc", "a")
     grids["cice.lat"][:] = cice_grid.y_t
     grids["cice.lon"][:] = cice_grid.x_t
     grids["cice.ang"][:] = cice_grid.angle_t
@@ -174,22 +203,87 @@ def main():
     grids.inputFile = metadata_input_cgrids
     grids.close()
 
-    areas = copy_netcdf(curr_careas, output_dir / "areas.nc")
+    areas = Dataset(work_dir / "areas.nc", "a")
     areas["cice.srf"][:] = cice_grid.area_t
     areas.history = metadata_history
     areas.inputFile = metadata_input_careas
     areas.close()
 
+def main():
+    parser = argparse.ArgumentParser(
+        description="Update the ocean grid in ACCESS-ESM1.6 from FMS legacy to mosaic format."
+    )
+
+    parser.add_argument(
+        "--output-dir",
+        type=str,
+        required=True,
+        help="The directory to write the output netcdf files.",
+    )
+
+    args = parser.parse_args()
+    output_dir = Path(os.path.abspath(args.output_dir))
+    # Fail straight away rather than after all the files have been created
+    if not output_dir.is_dir():
+        raise NotADirectoryError(f"Output directory {output_dir} does not exist")
+
+    curr_gspec = Path(
+        "/g/data/vk83/configurations/inputs/access-esm1p5/modern/share/ocean/grids/mosaic/global.1deg/2020.05.19/grid_spec.nc"
+    )
+    curr_cgrids = Path(
+        "/g/data/vk83/configurations/inputs/access-esm1p5/modern/share/coupler/grids/global.oi_1deg.a_N96/2020.05.19/grids.nc"
+    )
+    curr_careas = Path(
+        "/g/data/vk83/configurations/inputs/access-esm1p5/modern/share/coupler/grids/global.oi_1deg.a_N96/2020.05.19/areas.nc"
+    )
+    
+    # Get provenance metadata
+    # --------------------------------------------
+    this_file = os.path.normpath(__file__)
+    metadata_history = get_provenance_metadata(
+        this_file,
+        f"python {os.path.basename(this_file)} --output-dir={output_dir}"
+    )
+
+    # Create the output files
+    # --------------------------------------------
+    # Write all the files to node-local storage if there is any (e.g. $PBS_JOBFS on
+    # Gadi), since creating and updating netCDF files is slow on Lustre, then move them
+    # to the output directory. Move them even if something failed, so that whatever was
+    # completed is kept, as when writing directly to the output directory.
+    jobfs = os.environ.get("PBS_JOBFS")
+    work_dir = Path(tempfile.mkdtemp(dir=jobfs)) if jobfs else output_dir
+    staged = work_dir != output_dir
+    try:
+        create_outputs(
+            work_dir, curr_gspec, curr_cgrids, curr_careas, metadata_history, staged
+        )
+    finally:
+        if staged:
+            os.chdir(output_dir)
+            for f in work_dir.iterdir():
+                shutil.move(f, output_dir / f.name)
+            work_dir.rmdir()
+
 
 if __name__ == "__main__":
     import argparse
+    import importlib.util
 
     # Load FRE-NCtools 2024.05-1
     # (https://github.com/ACCESS-NRI/FRE-NCtools/releases/tag/2024.05-1)
     # --------------------------------------------
     FRENCTOOLS_VERSION = "2024.05-1"
     moduleshome = os.environ.get('MODULESHOME', default=None)
-    exec(open(Path(moduleshome) / "init/python.py").read())
+    # Import the environment modules python init as a module, rather than exec'ing its
+    # source, so it goes through the normal import machinery and bytecode cache
+    modules_spec = importlib.util.spec_from_file_location(
+        "_modules_init", Path(moduleshome) / "init/python.py"
+    )
+    modules_init = importlib.util.module_from_spec(modules_spec)
+    sys.modules["_modules_init"] = modules_init
+    modules_spec.loader.exec_module(modules_init)
+    module = modules_init.module
     module("use", "/g/data/vk83/modules")
     module("load", f"fre-nctools/{FRENCTOOLS_VERSION}")
 